@@ -7,10 +7,13 @@ import numpy as np
 from matplotlib import pyplot as plt
 from scipy.spatial import cKDTree
 import itertools
+import heapq
 import collections
 
 import shapely.ops
 import shapely.geometry
+import shapely.prepared
+import shapely.strtree
 
 import watershed_workflow.config
 import watershed_workflow.utils
@@ -85,30 +88,37 @@ def snap(hucs,
     # snap boundary triple junctions to river endpoints
     if triple_junctions_tol is not None:
         logging.info("  snapping polygon segment boundaries to river endpoints")
+        segments = list(hucs.segments)
         snap_polygon_endpoints(hucs, rivers, triple_junctions_tol)
         if not all(river.is_continuous() for river in rivers):
             logging.info("    ...resulted in inconsistent rivers!")
             return False
-        try:
-            list(hucs.polygons())
-        except AssertionError:
-            logging.info("    ...resulted in inconsistent HUCs")
-            return False
+        if _segments_modified(hucs, segments):
+            try:
+                list(hucs.polygons())
+            except AssertionError:
+                logging.info("    ...resulted in inconsistent HUCs")
+                return False
 
     # snap endpoints of all rivers to the boundary if close
     # note this is a null-op on cases dealt with above
     if reach_endpoints_tol is not None:
         logging.info("  snapping river endpoints to the polygon")
+        segments = list(hucs.segments)
+        # note this must be done serially -- each call splits HUC
+        # segments at the snapped points, replacing the segment handles
+        # that the next river would snap to
         for tree in rivers:
             snap_endpoints(tree, hucs, reach_endpoints_tol)
         if not all(river.is_continuous() for river in rivers):
             logging.info("    ...resulted in inconsistent rivers!")
             return False
-        try:
-            list(hucs.polygons())
-        except AssertionError:
-            logging.info("    ...resulted in inconsistent HUCs")
-            return False
+        if _segments_modified(hucs, segments):
+            try:
+                list(hucs.polygons())
+            except AssertionError:
+                logging.info("    ...resulted in inconsistent HUCs")
+                return False
 
     if cut_intersections:
         cut_and_snap_crossings(hucs, rivers, tol)
@@ -118,6 +128,16 @@ def snap(hucs,
     return rivers
 
 
+def _segments_modified(hucs, segments):
+    """Have the HUC segments changed since segments = list(hucs.segments)?
+
+    Snapping replaces modified segments with new objects, so this
+    checks identity rather than geometry.
+    """
+    return len(hucs.segments) != len(segments) or \
+        any(s1 is not s2 for (s1, s2) in zip(hucs.segments, segments))
+
+
 def snap_waterbodies(hucs, waterbodies, tol=_tol, cut_intersections=True):
     """Snap waterbodies to HUCs.
 
@@ -133,12 +153,12 @@ def snap_waterbodies(hucs, waterbodies, tol=_tol, cut_intersections=True):
         return True
     assert (len(waterbodies) > 0)
 
-    # snap endpoints of all rivers to the boundary if close
-    # note this is a null-op on cases dealt with above
+    # all polygon boundaries are formed from the HUC segments, so snap
+    # to all of the segments at once
     logging.info("  snapping waterbody points to the HUC boundary")
+    huc_segments = shapely.geometry.MultiLineString(list(hucs.segments))
     for i, wb in enumerate(waterbodies):
-        for polygon in hucs.polygons():
-            waterbodies[i] = shapely.ops.snap(wb, polygon, tol)
+        waterbodies[i] = shapely.ops.snap(wb, huc_segments, tol)
 
 
 def cut_and_snap_crossings(hucs, rivers, tol=_tol):
@@ -155,164 +175,200 @@ def cut_and_snap_crossings(hucs, rivers, tol=_tol):
     
     """
     logging.info("  cutting at crossings")
-    # Note this is O(M*N) where M is number of huc segments and N is
-    # number of reaches, and could be made more efficient.
+    # Spatial indices over the HUC segments limit the intersection
+    # tests to segments whose bounding box overlaps the reach.  These
+    # are rebuilt whenever a crossing splits a HUC segment.
+    boundary_index = _segment_index(hucs, hucs.boundaries)
+    intersection_index = _segment_index(hucs, hucs.intersections)
     for tree in rivers:
         for river_node in tree.preOrder():
-            _cut_and_snap_crossing(hucs, river_node, tol)
+            if _cut_and_snap_crossing(hucs, river_node, boundary_index, intersection_index, tol):
+                boundary_index = _segment_index(hucs, hucs.boundaries)
+                intersection_index = _segment_index(hucs, hucs.intersections)
 
     cleanup(rivers)
     return rivers
 
 
-def _cut_and_snap_crossing(hucs, reach_node, tol=_tol):
-    """Helper function for cut_and_snap_crossings()"""
-    r = reach_node.segment
+def _segment_index(hucs, spines):
+    """Builds a spatial index of the segments in a collection of spines.
 
-    # first deal with crossings of the HUC exterior boundary -- in
-    # this case, the reach segment gets split in two and the external
-    # one is remoevd.
-    for b, spine in hucs.boundaries.items():
-        for s, seg_handle in spine.items():
-            seg = hucs.segments[seg_handle]
+    Returns the STRtree and a list of (spine, seg_handle) entries, in
+    iteration order, whose indices are the items of the tree.
+    """
+    entries = [(spine, seg_handle) for spine in spines for seg_handle in spine]
+    tree = shapely.strtree.STRtree([hucs.segments[seg_handle] for (spine, seg_handle) in entries])
+    return tree, entries
 
-            if seg.intersects(r):
-                logging.info('intersection found')
-                new_spine = watershed_workflow.utils.cut(seg, r, tol)
-                new_reach_segs = watershed_workflow.utils.cut(r, seg, tol)
-                try:
-                    assert (len(new_reach_segs) == 1 or len(new_reach_segs) == 2)
-                    assert (len(new_spine) == 1 or len(new_spine) == 2)
-                    logging.info("  - cutting reach at external boundary of HUCs:")
-                    logging.info(f"      split HUC boundary seg into {len(new_spine)} pieces")
-                    logging.info(f"      split reach seg into {len(new_reach_segs)} pieces")
-
-                    # which piece of the reach are we keeping?
-                    if hucs.exterior().buffer(-tol).contains(
-                            shapely.geometry.Point(new_reach_segs[0].coords[0])):
-                        # keep the upstream (or only) reach seg
-                        if len(new_reach_segs) == 2:
-                            # confirm other/downstream reach is outside
-                            assert (not hucs.exterior().contains(
-                                shapely.geometry.Point(new_reach_segs[1].coords[-1])))
-                        reach_node.segment = new_reach_segs[0]
-
-                    elif len(new_reach_segs) == 2:
-                        if hucs.exterior().buffer(-tol).contains(
-                                shapely.geometry.Point(new_reach_segs[1].coords[-1])):
-                            # keep the downstream reach seg, confirm upstream is outside
-                            assert (not hucs.exterior().contains(
-                                shapely.geometry.Point(new_reach_segs[0].coords[0])))
-                            reach_node.segment = new_reach_segs[1]
-
-                    # keep both pieces of a split huc boundary segment
-                    # -- rename the first
-                    hucs.segments[seg_handle] = new_spine[0]
-                    if len(new_spine) > 1:
-                        # -- add the first
-                        assert (len(new_spine) == 2)
-                        new_handle = hucs.segments.add(new_spine[1])
-                        spine.add(new_handle)
-
-                except AssertionError:
-                    print('Error:')
-                    reachc = np.array(reach_node.segment.coords)
-                    segc = np.array(seg.coords)
-                    plt.plot(reachc[:, 0], reachc[:, 1], 'k--x')
-                    plt.plot(segc[:, 0], segc[:, 1], 'k--+')
-
-                    print(f'Reach split into {len(new_spine)} segments')
-                    if len(new_spine) > 0:
-                        r1c = np.array(new_spine[0].coords)
-                        plt.plot(r1c[:, 0], r1c[:, 1], 'rx', markersize=40)
-                    if len(new_spine) > 1:
-                        r2c = np.array(new_spine[1].coords)
-                        plt.plot(r2c[:, 0], r2c[:, 1], 'm+', markersize=40)
-
-                    print(f'Reach split into {len(new_reach_segs)} segments')
-                    if len(new_reach_segs) > 0:
-                        r1c = np.array(new_reach_segs[0].coords)
-                        plt.plot(r1c[:, 0], r1c[:, 1], 'b+', markersize=40)
-                        inter = watershed_workflow.utils.non_point_intersection(
-                            hucs.exterior(), new_reach_segs[0])
-                        print(r1c)
-                        print(f'  r1 intersects with boundary? {inter}')
-                    if len(new_reach_segs) > 1:
-                        r2c = np.array(new_reach_segs[1].coords)
-                        plt.plot(r2c[:, 0], r2c[:, 1], 'cx', markersize=40)
-                        inter = watershed_workflow.utils.non_point_intersection(
-                            hucs.exterior(), new_reach_segs[1])
-                        print(f'  r2 intersects with boundary? {inter}')
-                        print(r2c)
-                        inter = hucs.exterior().intersection(new_reach_segs[1])
-                        print(f'  r2 intersection = {inter}')
-
-                    plt.show()
-                    raise RuntimeError('Problem in cut_intersection')
 
-                break
+def _query_segment_index(index, shp):
+    """Generator for (spine, seg_handle) entries whose segment bounding box overlaps shp."""
+    tree, entries = index
+    for i in sorted(tree.query_items(shp)):
+        yield entries[i]
 
-    # now deal with crossings of the HUC interior boundary -- in this
-    # case, the reach segment is kept as one but the segment geometry
-    # is snapped to make sure the intersection is exact
-    for i, spine in hucs.intersections.items():
-        for s, seg_handle in spine.items():
-            seg = hucs.segments[seg_handle]
 
-            if seg.intersects(r):
-                new_spine = watershed_workflow.utils.cut(seg, r, tol)
-                new_reach_segs = watershed_workflow.utils.cut(r, seg, tol)
+def _cut_and_snap_crossing(hucs, reach_node, boundary_index, intersection_index, tol=_tol):
+    """Helper function for cut_and_snap_crossings()
+
+    Returns True if any HUC segment was modified, in which case the
+    spatial indices must be rebuilt.
+    """
+    r = reach_node.segment
+    # r is tested against many candidate segments, so prepare it once
+    r_p = shapely.prepared.prep(r)
+    modified = False
+
+    # first deal with crossings of the HUC exterior boundary -- in
+    # this case, the reach segment gets split in two and the external
+    # one is remoevd.  Only the first crossing of each spine is cut.
+    cut_spines = set()
+    for spine, seg_handle in _query_segment_index(boundary_index, r):
+        if id(spine) in cut_spines:
+            continue
+        seg = hucs.segments[seg_handle]
+
+        if r_p.intersects(seg):
+            logging.info('intersection found')
+            exterior = hucs.exterior()
+            exterior_p = shapely.prepared.prep(exterior)
+            interior_p = shapely.prepared.prep(exterior.buffer(-tol))
+            new_spine = watershed_workflow.utils.cut(seg, r, tol)
+            new_reach_segs = watershed_workflow.utils.cut(r, seg, tol)
+            try:
                 assert (len(new_reach_segs) == 1 or len(new_reach_segs) == 2)
                 assert (len(new_spine) == 1 or len(new_spine) == 2)
-                logging.info("  - snapping reach at internal boundary of HUCs")
-                if (len(new_reach_segs) == 2):
-                    reach_node.segment = shapely.geometry.LineString(
-                        list(new_reach_segs[0].coords) + list(new_reach_segs[1].coords)[1:])
-                else:
+                logging.info("  - cutting reach at external boundary of HUCs:")
+                logging.info(f"      split HUC boundary seg into {len(new_spine)} pieces")
+                logging.info(f"      split reach seg into {len(new_reach_segs)} pieces")
+
+                # which piece of the reach are we keeping?
+                if interior_p.contains(shapely.geometry.Point(new_reach_segs[0].coords[0])):
+                    # keep the upstream (or only) reach seg
+                    if len(new_reach_segs) == 2:
+                        # confirm other/downstream reach is outside
+                        assert (not exterior_p.contains(
+                            shapely.geometry.Point(new_reach_segs[1].coords[-1])))
                     reach_node.segment = new_reach_segs[0]
 
+                elif len(new_reach_segs) == 2:
+                    if interior_p.contains(shapely.geometry.Point(new_reach_segs[1].coords[-1])):
+                        # keep the downstream reach seg, confirm upstream is outside
+                        assert (not exterior_p.contains(
+                            shapely.geometry.Point(new_reach_segs[0].coords[0])))
+                        reach_node.segment = new_reach_segs[1]
+
+                # keep both pieces of a split huc boundary segment
+                # -- rename the first
                 hucs.segments[seg_handle] = new_spine[0]
                 if len(new_spine) > 1:
+                    # -- add the first
                     assert (len(new_spine) == 2)
                     new_handle = hucs.segments.add(new_spine[1])
                     spine.add(new_handle)
-                break
+
+            except AssertionError:
+                print('Error:')
+                reachc = np.array(reach_node.segment.coords)
+                segc = np.array(seg.coords)
+                plt.plot(reachc[:, 0], reachc[:, 1], 'k--x')
+                plt.plot(segc[:, 0], segc[:, 1], 'k--+')
+
+                print(f'Reach split into {len(new_spine)} segments')
+                if len(new_spine) > 0:
+                    r1c = np.array(new_spine[0].coords)
+                    plt.plot(r1c[:, 0], r1c[:, 1], 'rx', markersize=40)
+                if len(new_spine) > 1:
+                    r2c = np.array(new_spine[1].coords)
+                    plt.plot(r2c[:, 0], r2c[:, 1], 'm+', markersize=40)
+
+                print(f'Reach split into {len(new_reach_segs)} segments')
+                if len(new_reach_segs) > 0:
+                    r1c = np.array(new_reach_segs[0].coords)
+                    plt.plot(r1c[:, 0], r1c[:, 1], 'b+', markersize=40)
+                    inter = watershed_workflow.utils.non_point_intersection(
+                        exterior, new_reach_segs[0])
+                    print(r1c)
+                    print(f'  r1 intersects with boundary? {inter}')
+                if len(new_reach_segs) > 1:
+                    r2c = np.array(new_reach_segs[1].coords)
+                    plt.plot(r2c[:, 0], r2c[:, 1], 'cx', markersize=40)
+                    inter = watershed_workflow.utils.non_point_intersection(
+                        exterior, new_reach_segs[1])
+                    print(f'  r2 intersects with boundary? {inter}')
+                    print(r2c)
+                    inter = exterior.intersection(new_reach_segs[1])
+                    print(f'  r2 intersection = {inter}')
+
+                plt.show()
+                raise RuntimeError('Problem in cut_intersection')
+
+            modified = True
+            cut_spines.add(id(spine))
+
+    # now deal with crossings of the HUC interior boundary -- in this
+    # case, the reach segment is kept as one but the segment geometry
+    # is snapped to make sure the intersection is exact
+    cut_spines = set()
+    for spine, seg_handle in _query_segment_index(intersection_index, r):
+        if id(spine) in cut_spines:
+            continue
+        seg = hucs.segments[seg_handle]
+
+        if r_p.intersects(seg):
+            new_spine = watershed_workflow.utils.cut(seg, r, tol)
+            new_reach_segs = watershed_workflow.utils.cut(r, seg, tol)
+            assert (len(new_reach_segs) == 1 or len(new_reach_segs) == 2)
+            assert (len(new_spine) == 1 or len(new_spine) == 2)
+            logging.info("  - snapping reach at internal boundary of HUCs")
+            if (len(new_reach_segs) == 2):
+                reach_node.segment = shapely.geometry.LineString(
+                    list(new_reach_segs[0].coords) + list(new_reach_segs[1].coords)[1:])
+            else:
+                reach_node.segment = new_reach_segs[0]
+
+            hucs.segments[seg_handle] = new_spine[0]
+            if len(new_spine) > 1:
+                assert (len(new_spine) == 2)
+                new_handle = hucs.segments.add(new_spine[1])
+                spine.add(new_handle)
+            modified = True
+            cut_spines.add(id(spine))
+
+    return modified
 
 
 def snap_polygon_endpoints(hucs, rivers, tol=_tol):
     """Snaps the endpoints of HUC segments to endpoints of rivers."""
-    # make the kdTree of endpoints of all reaches
-    coords1 = np.array([reach.coords[-1] for river in rivers for reach in river.depthFirst()])
-    coords2 = np.array([reach.coords[0] for river in rivers for reach in river.leaves()])
-    coords = np.concatenate([coords1, coords2], axis=0)
-
-    # limit to x,y
-    if (coords.shape[1] != 2):
-        coords = coords[:, 0:2]
+    # make the kdTree of endpoints of all reaches, and beginpoints of
+    # all leaf reaches, limited to x,y
+    def reach_endpoints():
+        for river in rivers:
+            for node in river.preOrder():
+                if node.segment is not None:
+                    yield node.segment.coords[-1][0:2]
+                    if len(node.children) == 0:
+                        yield node.segment.coords[0][0:2]
 
-    debug_point = shapely.geometry.Point([-581678.5238123547, -378867.813358335])
+    coords = np.fromiter(itertools.chain.from_iterable(reach_endpoints()), 'd').reshape(-1, 2)
 
     kdtree = cKDTree(coords)
+
     # for each segment of the HUC spine, find the river outlet that is
-    # closest.  If within tolerance, move it
-    for seg_handle, seg in hucs.segments.items():
-        # check point 0, -1
-        endpoints = np.array([seg.coords[0], seg.coords[-1]])
-        # limit to x,y
-        if (endpoints.shape[1] != 2):
-            endpoints = endpoints[:, 0:2]
-        dists, inds = kdtree.query(endpoints)
-
-        #### DEBUG CODE #####
-        if debug_point.distance(shapely.geometry.Point(seg.coords[0])) < 10000:
-            dist = debug_point.distance(shapely.geometry.Point(seg.coords[0]))
-            print(
-                f'found a huc seg beginpoint: {seg.coords[0]} with distance {dist} < tol = {tol}?')
-
-        elif debug_point.distance(shapely.geometry.Point(seg.coords[-1])) < 10000:
-            dist = debug_point.distance(shapely.geometry.Point(seg.coords[-1]))
-            print(f'found a huc seg endpoint: {seg.coords[-1]} with distance {dist} < tol = {tol}?')
-        #### END DEBUG CODE #####
+    # closest.  If within tolerance, move it.  All segment endpoints
+    # are queried at once.
+    handles = list(hucs.segments.keys())
+    endpoints = np.empty((2 * len(handles), 2), 'd')
+    for i, seg_handle in enumerate(handles):
+        seg = hucs.segments[seg_handle]
+        endpoints[2 * i] = seg.coords[0][0:2]
+        endpoints[2 * i + 1] = seg.coords[-1][0:2]
+    all_dists, all_inds = kdtree.query(endpoints, workers=-1)
+    all_dists = all_dists.reshape(-1, 2)
+    all_inds = all_inds.reshape(-1, 2)
+
+    for seg_handle, dists, inds in zip(handles, all_dists, all_inds):
+        seg = hucs.segments[seg_handle]
 
         if dists.min() < tol:
             new_seg = list(seg.coords)
@@ -332,106 +388,147 @@ def snap_polygon_endpoints(hucs, rivers, tol=_tol):
             hucs.segments[seg_handle] = shapely.geometry.LineString(new_seg)
 
 
-def _closest_point(point, line, tol=_tol):
+def _closest_point(point, line, line_coords, tol=_tol):
     """Determine the closest location on line to point.  If that point is
     further than tol or already a coordinate in the line, returns
     None.  Otherwise, return the location.
+
+    line_coords is the array of the line's coordinates, which is
+    passed in so that it may be computed once per line.  Callers
+    should first check _in_neighborhood() to avoid the cost of finding
+    the nearest point on lines that are clearly too far away.
     """
-    if watershed_workflow.utils.in_neighborhood(shapely.geometry.Point(point), line, tol):
-        logging.debug("  - in neighborhood")
-        nearest_p = watershed_workflow.utils.nearest_point(line, point)
-        dist = watershed_workflow.utils.distance(nearest_p, point)
-        logging.debug("  - nearest p = {0}, dist = {1}, tol = {2}".format(nearest_p, dist, tol))
-        if dist < tol:
-            if dist < 1.e-7:
-                # filter case where the point is already there
-                if any(watershed_workflow.utils.close(point, c) for c in line.coords):
-                    return None
-            return nearest_p
+    nearest_p = watershed_workflow.utils.nearest_point(line, point)
+    dist = watershed_workflow.utils.distance(nearest_p, point)
+    logging.debug("  - nearest p = {0}, dist = {1}, tol = {2}".format(nearest_p, dist, tol))
+    if dist < tol:
+        if dist < 1.e-7:
+            # filter case where the point is already there
+            dists2 = ((line_coords[:, 0:2] - np.array(point[0:2]))**2).sum(axis=1)
+            if (dists2 < 1.e-7**2).any():
+                return None
+        return nearest_p
     return None
 
 
+def _in_neighborhood(point, bounds, tol=_tol):
+    """Is point within tol of the bounding box, bounds?"""
+    minx, miny, maxx, maxy = bounds
+    return minx - tol <= point[0] <= maxx + tol and miny - tol <= point[1] <= maxy + tol
+
+
+def _count_closer_coords(coords, xy):
+    """Counts the leading coordinates that are each further from xy than
+    the coordinate following them, leaving at least two coordinates.
+
+    These are the coordinates to remove when moving coords[0] to xy.
+    """
+    dx = coords[:, 0:2] - np.array(xy[0:2])
+    dist2 = np.einsum('ij,ij->i', dx, dx)
+    further = dist2[:-1] > dist2[1:]
+    n = len(further) if further.all() else int(np.argmin(further))
+    return min(n, len(coords) - 2)
+
+
 def snap_endpoints(tree, hucs, tol=_tol):
     """Snap river endpoints to huc segments and insert that point into
     the boundary.
 
-    Note this is O(n^2), and could be made more efficient.
     """
+    # HUC segments are not modified until all snaps have been found,
+    # so the segments of each component, their coordinates, and their
+    # bounds are gathered and spatially indexed once, up front.
+    components = list(itertools.chain(hucs.boundaries, hucs.intersections))
+    all_segs = []
+    for ci, component in enumerate(components):
+        for seg_handle in component:
+            seg = hucs.segments[seg_handle]
+            all_segs.append((ci, seg_handle, seg, np.array(seg.coords), seg.bounds))
+    seg_tree = shapely.strtree.STRtree([seg for (_, _, seg, _, _) in all_segs])
+
+    def candidate_segs(p, after=-1):
+        # indices of segments in components after the given one whose
+        # bounds are within tol of p
+        query_box = shapely.geometry.box(p[0] - tol, p[1] - tol, p[0] + tol, p[1] + tol)
+        return set(i for i in seg_tree.query_items(query_box) if all_segs[i][0] > after)
+
     to_add = []
     for node in tree.preOrder():
         river = node.segment
-        for b, component in itertools.chain(hucs.boundaries.items(), hucs.intersections.items()):
+        candidates = candidate_segs(river.coords[0]) | candidate_segs(river.coords[-1])
+
+        # components are visited in order, and a snap moves an
+        # endpoint, so candidates in later components are gathered
+        # again around the moved endpoint
+        while len(candidates) > 0:
+            ci = all_segs[min(candidates)][0]
+            component = components[ci]
+            segs = [all_segs[i][1:] for i in sorted(candidates) if all_segs[i][0] == ci]
+            candidates = set(i for i in candidates if all_segs[i][0] > ci)
 
             # note, this is done in two stages to allow it deal with both endpoints touching
-            for s, seg_handle in component.items():
-                seg = hucs.segments[seg_handle]
+            for seg_handle, seg, seg_coords, seg_bounds in segs:
+                if not _in_neighborhood(river.coords[0], seg_bounds, tol):
+                    continue
                 #logging.debug("SNAP P0:")
                 #logging.debug("  huc seg: %r"%seg.coords[:])
                 #logging.debug("  river: %r"%river.coords[:])
                 altered = False
                 logging.debug("  - checking river coord: %r" % list(river.coords[0]))
                 logging.debug("  - seg coords: {0}".format(list(seg.coords)))
-                new_coord = _closest_point(river.coords[0], seg, tol)
+                new_coord = _closest_point(river.coords[0], seg, seg_coords, tol)
                 logging.debug("  - new coord: {0}".format(new_coord))
                 if new_coord != None:
                     logging.info("    snapped river: %r to %r" % (river.coords[0], new_coord))
 
                     # move new_coord onto an existing segment coord
-                    dist = np.linalg.norm(np.array(seg.coords) - np.expand_dims(new_coord, 0),
-                                          2,
-                                          axis=1)
-                    assert (len(dist) == len(seg.coords))
-                    assert (len(dist.shape) == 1)
-                    i = int(np.argmin(dist))
-                    if (dist[i] < tol):
-                        new_coord = seg.coords[i]
+                    dx = seg_coords[:, 0:2] - np.array(new_coord[0:2])
+                    dist2 = np.einsum('ij,ij->i', dx, dx)
+                    i = int(np.argmin(dist2))
+                    if (dist2[i] < tol**2):
+                        new_coord = tuple(seg_coords[i])
 
                     # remove points that are closer
                     coords = list(river.coords)
-                    done = False
-                    while len(coords) > 2 and watershed_workflow.utils.distance(new_coord, coords[1]) < \
-                          watershed_workflow.utils.distance(new_coord, coords[0]):
-                        coords.pop(0)
+                    coords = coords[_count_closer_coords(np.array(coords), new_coord):]
                     coords[0] = new_coord
                     river = shapely.geometry.LineString(coords)
                     node.segment = river
                     to_add.append((seg_handle, component, 0, node))
+                    candidates |= candidate_segs(new_coord, ci)
                     break
 
             # second stage
-            for s, seg_handle in component.items():
-                seg = hucs.segments[seg_handle]
+            for seg_handle, seg, seg_coords, seg_bounds in segs:
+                if not _in_neighborhood(river.coords[-1], seg_bounds, tol):
+                    continue
                 # logging.debug("SNAP P1:")
                 # logging.debug("  huc seg: %r"%seg.coords[:])
                 # logging.debug("  river: %r"%river.coords[:])
                 altered = False
                 logging.debug("  - checking river coord: %r" % list(river.coords[-1]))
                 logging.debug("  - seg coords: {0}".format(list(seg.coords)))
-                new_coord = _closest_point(river.coords[-1], seg, tol)
+                new_coord = _closest_point(river.coords[-1], seg, seg_coords, tol)
                 logging.debug("  - new coord: {0}".format(new_coord))
                 if new_coord != None:
                     logging.info("  - snapped river: %r to %r" % (river.coords[-1], new_coord))
 
                     # move new_coord onto an existing segment coord
-                    dist = np.linalg.norm(np.array(seg.coords) - np.expand_dims(new_coord, 0),
-                                          2,
-                                          axis=1)
-                    assert (len(dist) == len(seg.coords))
-                    assert (len(dist.shape) == 1)
-                    i = int(np.argmin(dist))
-                    if (dist[i] < tol):
-                        new_coord = seg.coords[i]
+                    dx = seg_coords[:, 0:2] - np.array(new_coord[0:2])
+                    dist2 = np.einsum('ij,ij->i', dx, dx)
+                    i = int(np.argmin(dist2))
+                    if (dist2[i] < tol**2):
+                        new_coord = tuple(seg_coords[i])
 
                     # remove points that are closer
                     coords = list(river.coords)
-                    done = False
-                    while len(coords) > 2 and \
-                       watershed_workflow.utils.distance(new_coord, coords[-2]) < watershed_workflow.utils.distance(new_coord, coords[-1]):
-                        coords.pop(-1)
+                    coords = coords[:len(coords)
+                                    - _count_closer_coords(np.array(coords[::-1]), new_coord)]
                     coords[-1] = new_coord
                     river = shapely.geometry.LineString(coords)
                     node.segment = river
                     to_add.append((seg_handle, component, -1, node))
+                    candidates |= candidate_segs(new_coord, ci)
                     break
 
     # find the list of points to add to a given segment
@@ -441,24 +538,39 @@ def snap_endpoints(tree, hucs, tol=_tol):
             to_add_dict[seg_handle] = list()
         to_add_dict[seg_handle].append((component, endpoint, node))
 
-    # find the set of points to add to each given segment
-    def equal(p1, p2):
-        if watershed_workflow.utils.close(p1[2].segment.coords[p1[1]], p2[2].segment.coords[p2[1]],
-                                          1.e-5):
-            assert (p1[0] == p2[0])
-            return True
-        else:
-            return False
-
+    # find the set of points to add to each given segment -- points
+    # are considered equal if they round to the same coordinate at
+    # 1.e-5, and are hashed by that coordinate
     to_add_dict2 = dict()
     for seg_handle, insert_list in to_add_dict.items():
+        seen = dict()
         new_list = []
-        for p1 in insert_list:
-            if (all(not equal(p1, p2) for p2 in new_list)):
-                new_list.append(p1)
+        for p in insert_list:
+            c = p[2].segment.coords[p[1]]
+            key = (round(c[0] * 1.e5), round(c[1] * 1.e5))
+            if key in seen:
+                assert (seen[key] == p[0])
+            else:
+                seen[key] = p[0]
+                new_list.append(p)
         to_add_dict2[seg_handle] = new_list
 
     # add these points to the segment
+    def sort_by_arclength(seg, n_coords, new_coords):
+        # merge new_coords with the first n_coords coordinates of seg
+        # and sort by arclength along seg.  The arclength of the seg's
+        # own coordinates is the cumulative length, so only the new
+        # coords must be projected.
+        coords = np.array(seg.coords)
+        dx = np.diff(coords[:, 0:2], axis=0)
+        arclens = np.concatenate([[0.], np.cumsum(np.hypot(dx[:, 0], dx[:, 1]))])
+        old_coords = [[tuple(c), 0] for c in coords[0:n_coords]]
+
+        new_arclens = [seg.project(shapely.geometry.Point(c)) for (c, f) in new_coords]
+        order = np.argsort(np.concatenate([new_arclens, arclens[0:n_coords]]), kind='stable')
+        all_coords = new_coords + old_coords
+        return [all_coords[i] for i in order]
+
     for seg_handle, insert_list in to_add_dict2.items():
         seg = hucs.segments[seg_handle]
         # make a list of the coords and a flag to indicate a new
@@ -467,24 +579,14 @@ def snap_endpoints(tree, hucs, tol=_tol):
         # Note this needs special care if the seg is a loop, or else the endpoint gets sorted twice
         if not watershed_workflow.utils.close(seg.coords[0], seg.coords[-1]):
             new_coords = [[p[2].segment.coords[p[1]], 1] for p in insert_list]
-            old_coords = [
-                [c, 0] for c in seg.coords
-                if not any(watershed_workflow.utils.close(c, nc, tol) for nc in new_coords)
-            ]
-            new_seg_coords = sorted(new_coords + old_coords,
-                                    key=lambda a: seg.project(shapely.geometry.Point(a)))
+            new_seg_coords = sort_by_arclength(seg, len(seg.coords), new_coords)
 
             # determine the new coordinate indices
             breakpoint_inds = [i for i, (c, f) in enumerate(new_seg_coords) if f == 1]
 
         else:
             new_coords = [[p[2].segment.coords[p[1]], 1] for p in insert_list]
-            old_coords = [
-                [c, 0] for c in seg.coords[:-1]
-                if not any(watershed_workflow.utils.close(c, nc, tol) for nc in new_coords)
-            ]
-            new_seg_coords = sorted(new_coords + old_coords,
-                                    key=lambda a: seg.project(shapely.geometry.Point(a)))
+            new_seg_coords = sort_by_arclength(seg, len(seg.coords) - 1, new_coords)
             breakpoint_inds = [i for i, (c, f) in enumerate(new_seg_coords) if f == 1]
             assert (len(breakpoint_inds) > 0)
             new_seg_coords = new_seg_coords[breakpoint_inds[0]:] + new_seg_coords[
@@ -522,19 +624,26 @@ def cleanup(rivers, simp_tol=None, prune_tol=_tol, merge_tol=_tol, preserve_catc
     2. pruning all leaf nodes of length < prune_tol
     3. merging all internal nodes of length < merge_tol
     """
-    # simplify
+    # simplify, keeping the simplified reaches and their lengths for merging
     if simp_tol is not None:
-        for tree in rivers:
-            simplify(tree, simp_tol)
+        simplified = [_simplify(tree, simp_tol) for tree in rivers]
+    else:
+        simplified = [None for tree in rivers]
 
     assert (all([river.is_consistent() for river in rivers]))
     for river in rivers:
         assert (river.is_continuous())
 
     # prune short leaf branches and merge short interior reaches
-    for tree in rivers:
+    for tree, reaches in zip(rivers, simplified):
         if merge_tol is not None:
-            merge(tree, merge_tol)
+            if reaches is None:
+                merge(tree, merge_tol)
+            else:
+                _merge_short([
+                    node for (node, length) in zip(*reaches)
+                    if node.parent is not None and length < merge_tol
+                ], merge_tol)
         if merge_tol != prune_tol and prune_tol is not None:
             pruneBySegmentLength(tree, prune_tol, preserve_catchments)
 
@@ -550,10 +659,14 @@ def cleanup(rivers, simp_tol=None, prune_tol=_tol, merge_tol=_tol, preserve_catc
 
 def pruneBySegmentLength(tree, prune_tol=10, preserve_catchments=False):
     """Removes any leaf segments that are shorter than prune_tol"""
-    for leaf in tree.leaf_nodes():
-        if leaf.segment.length < prune_tol:
+    # pruning a leaf does not change any other leaf, so gather the
+    # leaves and their lengths once up front
+    leaves = list(tree.leaf_nodes())
+    lengths = [leaf.segment.length for leaf in leaves]
+    for leaf, length in zip(leaves, lengths):
+        if length < prune_tol:
             logging.info("  ...cleaned leaf segment of length: %g at centroid %r" %
-                         (leaf.segment.length, leaf.segment.centroid.coords[0]))
+                         (length, leaf.segment.centroid.coords[0]))
             leaf.prune(preserve_catchments)
 
 
@@ -597,6 +710,30 @@ def pruneByArea(rivers, area, prop='DivergenceRoutedDrainAreaSqKm', preserve_cat
     return sufficiently_big_rivers
 
 
+def _hydroseq_index(river):
+    """Dictionary of the nodes in river, keyed by HydrologicSequence."""
+    return dict((node.properties.get('HydrologicSequence'), node) for node in river.preOrder())
+
+
+def _prune_indexed(node, hydroseq_index, preserve_catchments=False):
+    """Prunes node, removing it and its upstream nodes from hydroseq_index."""
+    for n in node.preOrder():
+        hydroseq_index.pop(n.properties.get('HydrologicSequence'), None)
+    node.prune(preserve_catchments)
+
+
+def _divergent_leaves(river):
+    """Generator for the leaves of river with DivergenceCode 2.
+
+    Candidates are gathered before any are pruned; leaves that have
+    since been pruned along with an earlier joiner are skipped.
+    """
+    leaves = [leaf for leaf in river.leaf_nodes() if leaf.properties['DivergenceCode'] == 2]
+    for leaf in leaves:
+        if leaf.getRoot() is river:
+            yield leaf
+
+
 def removeDiversions(rivers, preserve_catchments=False):
     """Removes diversions, but not braids."""
     logging.info("Remove diversions...")
@@ -605,23 +742,23 @@ def removeDiversions(rivers, preserve_catchments=False):
         keep_river = True
         count_tribs = 0
         count_reaches = 0
-        for leaf in river.leaf_nodes():
-            if leaf.properties['DivergenceCode'] == 2:
-                # is a braid or a diversion
-                if river.getNode(leaf.properties['UpstreamMainPathHydroSeq']) is None:
-                    # diversion!
-                    try:
-                        joiner = next(n for n in leaf.pathToRoot()
-                                      if n.parent is not None and len(n.parent.children) > 1)
-                    except StopIteration:
-                        # no joiner means kill the whole tree
-                        logging.info(f'  ... remove diversion river with {len(river)} reaches.')
-                        keep_river = False
-                        break
-                    else:
-                        count_tribs += 1
-                        count_reaches += len(joiner)
-                        joiner.prune(preserve_catchments)
+        hydroseq_index = _hydroseq_index(river)
+        for leaf in _divergent_leaves(river):
+            # is a braid or a diversion
+            if leaf.properties['UpstreamMainPathHydroSeq'] not in hydroseq_index:
+                # diversion!
+                try:
+                    joiner = next(n for n in leaf.pathToRoot()
+                                  if n.parent is not None and len(n.parent.children) > 1)
+                except StopIteration:
+                    # no joiner means kill the whole tree
+                    logging.info(f'  ... remove diversion river with {len(river)} reaches.')
+                    keep_river = False
+                    break
+                else:
+                    count_tribs += 1
+                    count_reaches += len(joiner)
+                    _prune_indexed(joiner, hydroseq_index, preserve_catchments)
 
         if keep_river:
             logging.info(
@@ -638,23 +775,23 @@ def removeBraids(rivers, preserve_catchments=False):
     for river in rivers:
         count_tribs = 0
         count_reaches = 0
+        hydroseq_index = _hydroseq_index(river)
+
+        for leaf in _divergent_leaves(river):
+            # is a braid or a diversion?
+            if leaf.properties['UpstreamMainPathHydroSeq'] in hydroseq_index:
+                # braid!
 
-        for leaf in river.leaf_nodes():
-            if leaf.properties['DivergenceCode'] == 2:
-                # is a braid or a diversion?
-                if river.getNode(leaf.properties['UpstreamMainPathHydroSeq']) is not None:
-                    # braid!
-
-                    try:
-                        joiner = next(n for n in leaf.pathToRoot()
-                                      if n.parent is not None and len(n.parent.children) > 1)
-                    except StopIteration:
-                        assert (False)
-                        # this should not be possible, because our braid must come back somewhere
-                    else:
-                        count_tribs += 1
-                        count_reaches += len(joiner)
-                        joiner.prune(preserve_catchments)
+                try:
+                    joiner = next(n for n in leaf.pathToRoot()
+                                  if n.parent is not None and len(n.parent.children) > 1)
+                except StopIteration:
+                    assert (False)
+                    # this should not be possible, because our braid must come back somewhere
+                else:
+                    count_tribs += 1
+                    count_reaches += len(joiner)
+                    _prune_indexed(joiner, hydroseq_index, preserve_catchments)
 
         logging.info(
             f'... removed {count_tribs} braids with {count_reaches} reaches from a river of length {len(river)}'
@@ -680,21 +817,20 @@ def removeDivergences(rivers, preserve_catchments=False):
         keep_river = True
         count_tribs = 0
         count_reaches = 0
-        for leaf in river.leaf_nodes():
-            if leaf.properties['DivergenceCode'] == 2:
-                # diversion!
-                try:
-                    joiner = next(n for n in leaf.pathToRoot()
-                                  if n.parent is not None and len(n.parent.children) > 1)
-                except StopIteration:
-                    # no joiner means kill the whole tree
-                    logging.info(f'  ... remove divergence river with {len(river)} reaches.')
-                    keep_river = False
-                    break
-                else:
-                    count_tribs += 1
-                    count_reaches += len(joiner)
-                    joiner.prune(preserve_catchments)
+        for leaf in _divergent_leaves(river):
+            # diversion!
+            try:
+                joiner = next(n for n in leaf.pathToRoot()
+                              if n.parent is not None and len(n.parent.children) > 1)
+            except StopIteration:
+                # no joiner means kill the whole tree
+                logging.info(f'  ... remove divergence river with {len(river)} reaches.')
+                keep_river = False
+                break
+            else:
+                count_tribs += 1
+                count_reaches += len(joiner)
+                joiner.prune(preserve_catchments)
 
         if keep_river:
             logging.info(
@@ -708,14 +844,10 @@ def removeDivergences(rivers, preserve_catchments=False):
 def filterSmallRivers(rivers, count):
     """Remove any rivers with fewer than count reaches."""
     logging.info(f"Removing rivers with fewer than {count} reaches.")
-    new_rivers = []
-    for river in rivers:
-        ltree = len(river)
-        if ltree < count:
-            logging.debug("  ...removing river with %d reaches" % ltree)
-        else:
-            new_rivers.append(river)
-            logging.debug("  ...keeping river with %d reaches" % ltree)
+    counts = np.fromiter(map(len, rivers), dtype=np.int32, count=len(rivers))
+    keep = counts >= count
+    new_rivers = [river for (river, k) in zip(rivers, keep) if k]
+    logging.debug("  ...removed %d, kept %d rivers", (~keep).sum(), keep.sum())
     logging.info(f'... removed {len(rivers) - len(new_rivers)} rivers')
     return new_rivers
 
@@ -726,26 +858,173 @@ def merge(river, tol=_tol):
     This function merges the "short" segment into the parent segment
 
     """
-    for node in list(river.preOrder()):
-        if node.segment.length < tol and node.parent is not None:
-            logging.info(
-                "  ...cleaned inner segment of length %g at centroid %r with id %r" %
-                (node.segment.length, node.segment.centroid.coords[0], node.properties['ID']))
-
-            for sibling in node.siblings():
-                sibling.moveCoordinate(-1, node.segment.coords[0])
+    # only short reaches are merged, so collect just those
+    _merge_short([n for n in river.preOrder() if n.parent is not None and n.segment.length < tol],
+                 tol)
+
+
+def _merge_short(short, tol):
+    """Helper function for merge(), given the short nodes of a river."""
+    # merging moves the endpoints of neighboring reaches, so check
+    # again before merging each one, and add any that have become short
+    merged = []
+    for node in short:  # note, short is appended to in this loop
+        length = node.segment.length
+        if length < tol and node.parent is not None:
+            merged.append((node.properties.get('ID'), length))
+
+            # siblings become children of node -- make a copy, as this
+            # modifies the parent's list of children
+            children = node.parent.children
+            if len(children) == 1:
+                siblings = []
+            elif len(children) == 2:
+                # the common case, a confluence of two reaches
+                siblings = [children[1] if children[0] is node else children[0]]
+            else:
+                siblings = list(node.siblings())
+
+            new_endpoint = node.segment.coords[0]
+            for sibling in siblings:
+                if sibling.segment.coords[-1] != new_endpoint:
+                    sibling.moveCoordinate(-1, new_endpoint)
+                    if sibling.segment.length < tol:
+                        short.append(sibling)
                 sibling.remove()
                 node.addChild(sibling)
 
-            assert (len(list(node.siblings())) == 0)
+            assert (len(node.parent.children) == 1)
+            parent = node.parent
             node.merge()
+            if parent.parent is not None and parent.segment.length < tol:
+                short.append(parent)
 
+    if len(merged) > 0:
+        logging.info("  ...cleaned %d inner segments, (id, length): %r", len(merged), merged)
 
-def simplify(river, tol=_tol):
-    """Simplify, IN PLACE, all reaches."""
-    for node in river.preOrder():
-        if node.segment is not None:
-            new_seg = node.segment.simplify(tol)
+
+def _douglas_peucker(coords, tol, max_vertices=None, keep=None):
+    """Douglas-Peucker simplification of an (n,2) or (n,3) coordinate array.
+
+    Returns a boolean mask of the coordinates to keep, which always
+    includes both endpoints.  As in GEOS, distances are measured to
+    the segment between the current endpoints.  These are compared
+    squared and scaled by the squared segment length, avoiding both
+    the sqrt and the divide.
+
+    Ranges are refined in order of decreasing distance, so if
+    max_vertices is provided, refinement stops once that many
+    coordinates are kept and the most significant ones are retained.
+
+    If keep is provided, the mask is written into it, allowing a
+    caller to reuse one buffer for many lines.
+    """
+    n = len(coords)
+    if keep is None:
+        keep = np.empty(n, dtype=bool)
+    keep[:] = False
+    keep[0] = True
+    keep[-1] = True
+    tol2 = tol * tol
+
+    def push(lo, hi):
+        # find the coordinate in (lo, hi) furthest from the lo-hi segment
+        if hi - lo < 2:
+            return
+        x1, y1 = coords[lo, 0:2]
+        dx = coords[hi, 0] - x1
+        dy = coords[hi, 1] - y1
+        px = coords[lo + 1:hi, 0] - x1
+        py = coords[lo + 1:hi, 1] - y1
+        den = dx*dx + dy*dy
+        if den > 0:
+            # squared distance times den.  For coordinates that project
+            # onto the segment this is the squared cross product;
+            # beyond either end, |p|^2 den = cross^2 + along^2 adds the
+            # squared overshoot, so no branch is needed.
+            along = px*dx + py*dy
+            cross = px*dy - py*dx
+            d2 = cross*cross + np.minimum(along, 0)**2 + np.maximum(along - den, 0)**2
+        else:
+            d2 = px*px + py*py
+            den = 1.
+
+        k = int(np.argmax(d2))
+        if d2[k] > tol2 * den:
+            heapq.heappush(heap, (-d2[k] / den, lo, hi, k + lo + 1))
+
+    # a heap of (lo, hi) index ranges, keyed by their furthest distance,
+    # avoids recursion
+    heap = []
+    push(0, n - 1)
+    count = min(n, 2)
+    while len(heap) > 0 and (max_vertices is None or count < max_vertices):
+        _, lo, hi, k = heapq.heappop(heap)
+        keep[k] = True
+        count += 1
+        push(lo, k)
+        push(k, hi)
+    return keep
+
+
+def _gather_river_coords(river):
+    """Gathers the coordinates of all reaches in river into one buffer.
+
+    Returns the nodes with a segment, in preorder, the coordinate
+    array of each, a flat (N,2) array of all of their x,y coordinates,
+    and the offsets of each node's coordinates into that array.
+    """
+    nodes = [node for node in river.preOrder() if node.segment is not None]
+    node_coords = [np.array(node.segment.coords) for node in nodes]
+    offsets = np.zeros(len(nodes) + 1, dtype=int)
+    np.cumsum([len(coords) for coords in node_coords], out=offsets[1:])
+    xy = np.empty((offsets[-1], 2), 'd')
+    for coords, lo, hi in zip(node_coords, offsets[:-1], offsets[1:]):
+        xy[lo:hi] = coords[:, 0:2]
+    return nodes, node_coords, xy, offsets
+
+
+def simplify(river, tol=_tol, max_vertices=None, preserve_topology=False):
+    """Simplify, IN PLACE, all reaches.
+
+    Each reach is simplified by GEOS, using the Douglas-Peucker
+    algorithm, or the (slower) topology preserving simplifier if
+    preserve_topology is True, which also ensures no reach
+    self-intersects.  Endpoints of all reaches are preserved, so the
+    tree stays connected.
+
+    If max_vertices is provided, no reach keeps more than that many
+    coordinates.  GEOS cannot limit the number of coordinates, so in
+    that case Douglas-Peucker is applied to the coordinates of all
+    reaches, gathered into a single array; preserve_topology is not
+    supported in that case.
+    """
+    _simplify(river, tol, max_vertices, preserve_topology)
+
+
+def _simplify(river, tol, max_vertices=None, preserve_topology=False):
+    """Helper function for simplify().
+
+    Returns the simplified nodes and their new lengths, so that these
+    may be used by merge without computing them again.
+    """
+    if max_vertices is None:
+        nodes = [node for node in river.preOrder() if node.segment is not None]
+        for node in nodes:
+            new_seg = node.segment.simplify(tol, preserve_topology=preserve_topology)
             assert (watershed_workflow.utils.close(new_seg.coords[0], node.segment.coords[0]))
             assert (watershed_workflow.utils.close(new_seg.coords[-1], node.segment.coords[-1]))
             node.segment = new_seg
+        return nodes, np.array([node.segment.length for node in nodes])
+
+    assert (not preserve_topology)
+    nodes, node_coords, xy, offsets = _gather_river_coords(river)
+    keep = np.empty(len(xy), dtype=bool)
+    for lo, hi in zip(offsets[:-1], offsets[1:]):
+        _douglas_peucker(xy[lo:hi], tol, max_vertices, keep[lo:hi])
+
+    # the new segments are built from the original coordinates, and
+    # the kernel always keeps the first and last, so endpoints are preserved
+    for node, coords, lo, hi in zip(nodes, node_coords, offsets[:-1], offsets[1:]):
+        node.segment = shapely.geometry.LineString(coords[keep[lo:hi]])
+    return nodes, np.array([node.segment.length for node in nodes])
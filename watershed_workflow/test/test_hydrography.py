@@ -479,3 +479,115 @@ def test_remove_divergences(braided_stream):
     hydroseq = [r.properties['HydrologicSequence'] for r in rivers[0]]
     expected = [1, 2, 3, 6]
     assert (all((e == h) for (e, h) in zip(expected, hydroseq)))
+
+
+def test_snap_waterbodies(two_boxes):
+    hucs = watershed_workflow.split_hucs.SplitHUCs(two_boxes)
+    wbs = [
+        shapely.geometry.Polygon([(9.95, 4.95), (9, 4), (11, 4)]),
+        shapely.geometry.Polygon([(0.05, 4.95), (1, 4), (2, 4.5)]),
+    ]
+    watershed_workflow.hydrography.snap_waterbodies(hucs, wbs, 0.1)
+
+    # snapped to the triple junction
+    assert (watershed_workflow.utils.close(
+        wbs[0], shapely.geometry.Polygon([(10, 5), (9, 4), (11, 4)])))
+    # snapped to a corner of only the first polygon
+    assert (watershed_workflow.utils.close(
+        wbs[1], shapely.geometry.Polygon([(0, 5), (1, 4), (2, 4.5)])))
+
+
+def test_simplify():
+    np.random.seed(0)
+    coords = np.cumsum(np.random.random((200, 2)) - 0.5, axis=0)
+    seg = shapely.geometry.LineString(coords)
+    river = watershed_workflow.river_tree.River(seg)
+    watershed_workflow.hydrography.simplify(river, 0.5)
+
+    expected = seg.simplify(0.5, preserve_topology=False)
+    assert (watershed_workflow.utils.close(river.segment, expected))
+    assert (len(river.segment.coords) < len(coords))
+
+
+def test_simplify_max_vertices():
+    np.random.seed(0)
+    coords = np.cumsum(np.random.random((200, 2)) - 0.5, axis=0)
+    seg = shapely.geometry.LineString(coords)
+    river = watershed_workflow.river_tree.River(seg)
+    watershed_workflow.hydrography.simplify(river, 0.5, max_vertices=10)
+
+    assert (len(river.segment.coords) == 10)
+    assert (watershed_workflow.utils.close(river.segment.coords[0], seg.coords[0]))
+    assert (watershed_workflow.utils.close(river.segment.coords[-1], seg.coords[-1]))
+
+
+def test_merge():
+    river = watershed_workflow.river_tree.River(shapely.geometry.LineString([(0, 0), (-10, 0)]))
+    short = river.addChild(shapely.geometry.LineString([(0.001, 0), (0, 0)]))
+    river.addChild(shapely.geometry.LineString([(0, 5), (0, 0)]))
+    river.addChild(shapely.geometry.LineString([(0, -5), (0, 0)]))
+    for i, node in enumerate(river.preOrder()):
+        node.properties['ID'] = str(i)
+
+    watershed_workflow.hydrography.merge(river, 0.01)
+    assert (len(river) == 3)
+    assert (short not in river.preOrder())
+    assert (river.is_continuous())
+    assert (watershed_workflow.utils.close(river.segment.coords[0], (0.001, 0)))
+
+
+def test_simplify_preserve_topology():
+    np.random.seed(0)
+    coords = np.cumsum(np.random.random((200, 2)) - 0.5, axis=0)
+    seg = shapely.geometry.LineString(coords)
+    river = watershed_workflow.river_tree.River(seg)
+    watershed_workflow.hydrography.simplify(river, 0.5, preserve_topology=True)
+
+    assert (watershed_workflow.utils.close(river.segment, seg.simplify(0.5)))
+
+
+def test_snap_endpoints_near_junction():
+    # the river endpoint snaps to the shared edge within tol of its
+    # (10, 4.95) vertex, which is kept as a junction
+    tb = [
+        shapely.geometry.Polygon([(0, -5), (10, -5), (10, 4.95), (10, 5), (0, 5)]),
+        shapely.geometry.Polygon([(10, -5), (20, -5), (20, 5), (10, 5), (10, 4.95)]),
+    ]
+    rs = [shapely.geometry.LineString([(10.03, 4.88), (5, 0)]), ]
+    hucs, rivers = data(tb, rs)
+    watershed_workflow.hydrography.snap_endpoints(rivers[0], hucs, 0.1)
+
+    assert (watershed_workflow.utils.close(rivers[0].segment.coords[0], (10, 4.95)))
+    list(hucs.polygons())
+    assert (watershed_workflow.utils.close(
+        hucs.polygon(1),
+        shapely.geometry.Polygon([(10, -5), (20, -5), (20, 5), (10, 5), (10, 4.95)])))
+
+
+def _river_with_shortened_sibling():
+    # merging a shortens its sibling b, which must then be merged too
+    river = watershed_workflow.river_tree.River(shapely.geometry.LineString([(0, 0), (-10, 0)]))
+    a = river.addChild(shapely.geometry.LineString([(0.5, 0.5), (0, 0)]))
+    river.addChild(shapely.geometry.LineString([(1, 1), (0, 0)]))
+    a.addChild(shapely.geometry.LineString([(0.5, 10), (0.5, 0.5)]))
+    for i, node in enumerate(river.preOrder()):
+        node.properties['ID'] = str(i)
+    return river
+
+
+def test_merge_shortened_sibling():
+    river = _river_with_shortened_sibling()
+    watershed_workflow.hydrography.merge(river, 1.0)
+    assert (len(river) == 2)
+    assert (river.is_continuous())
+    assert (all(node.segment.length > 1.0 for node in river.preOrder()))
+    assert (watershed_workflow.utils.close(river.segment.coords[0], (1, 1)))
+
+
+def test_cleanup_shortened_sibling():
+    # the merge after simplification must use the live lengths, not
+    # just those computed while simplifying
+    river = _river_with_shortened_sibling()
+    watershed_workflow.hydrography.cleanup([river], simp_tol=0.01, prune_tol=None, merge_tol=1.0)
+    assert (len(river) == 2)
+    assert (all(node.segment.length > 1.0 for node in river.preOrder()))
@@ -129,3 +129,4 @@ def test_merge():
     del n2
     assert (n1.segment.length == 2)
     assert (len(n1.children) == 0)
+
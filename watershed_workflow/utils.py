@@ -631,10 +631,31 @@ def cut(line, cutline, tol=1.e-5):
     segs = []
     coords = list(line.coords)
 
+    # only the pieces of line whose bounding box overlaps that of
+    # cutline can intersect it, and these are tested against a
+    # prepared cutline
+    xy = np.array(coords)[:, 0:2]
+    lower = np.minimum(xy[:-1], xy[1:])
+    upper = np.maximum(xy[:-1], xy[1:])
+    minx, miny, maxx, maxy = cutline.bounds
+    may_intersect = (upper[:, 0] >= minx) & (lower[:, 0] <= maxx) & \
+        (upper[:, 1] >= miny) & (lower[:, 1] <= maxy)
+    cutline_p = shapely.prepared.prep(cutline)
+
     segcoords = [coords[0], ]
     i = 0
     while i < len(coords) - 1:
+        if not may_intersect[i]:
+            segcoords.append(coords[i + 1])
+            i += 1
+            continue
+
         seg = shapely.geometry.LineString(coords[i:i + 2])
+        if not cutline_p.intersects(seg):
+            segcoords.append(coords[i + 1])
+            i += 1
+            continue
+
         #logging.debug("Intersecting seg %d"%i)
         point = seg.intersection(cutline)
         if type(point) is shapely.geometry.LineString and len(point.coords) == 0: